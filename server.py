@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from html import escape
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+import psycopg
+
+from main import (DEFAULT_PARALLELISM, HEATMAP_CELL_SIZES, HEATMAP_FILTER, HEATMAP_ZOOM, QUERY_LOG, ChartRenderer,
+                  DashboardStats, QueryScheduler, collect_region_statistics, collect_statistics, dashboard_html,
+                  database_fingerprint, fetch_region_geometries, heatmap_map, heatmap_section, libpq_url, make_engine,
+                  region_values_cte, regions_cte)
+
+# Long-running dashboard server: the statistics are gathered once per database state with the same
+# code paths as main.py and kept in memory; only the filtered heatmap is queried per request, over
+# an async psycopg pool. Identical concurrent requests share one query/render, and every response
+# carries an ETag derived from the database fingerprint, so unchanged pages cost a 304.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_POOL_SIZE = 8
+# Seconds between database fingerprint checks; the aggregates are rebuilt only when it changes
+DEFAULT_REFRESH_INTERVAL = 60
+# The Czech kraje are admin_level 6 boundaries
+KRAJ_ADMIN_LEVEL = 6
+# Rendered responses (and heatmaps) kept per process; keys include the fingerprint, so stale ones just age out
+RESPONSE_CACHE_SIZE = 256
+
+
+class AsyncPool:
+    """Fixed-size pool of async psycopg connections, opened on first use"""
+
+    def __init__(self, url, size=DEFAULT_POOL_SIZE, query_timeout=None):
+        self.url = url
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.options = f"-c statement_timeout={int(query_timeout * 1000)}" if query_timeout else None
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        async with self.slots:
+            conn = self.idle.pop() if self.idle else None
+            if conn is None or conn.closed or conn.broken:
+                kwargs = {'options': self.options} if self.options else {}
+                conn = await psycopg.AsyncConnection.connect(self.url, autocommit=True, **kwargs)
+            try:
+                yield conn
+            finally:
+                if not (conn.closed or conn.broken):
+                    self.idle.append(conn)
+
+    async def close(self):
+        while self.idle:
+            await self.idle.pop().close()
+
+
+class Coalescer:
+    """Computes each key once: concurrent callers share the in-flight task, later ones the cached result"""
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.inflight = {}
+        self.hits = self.coalesced = self.misses = 0
+
+    async def get(self, key, factory):
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        task = self.inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self.inflight[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda done: self.finish(key, done))
+        # shield: one client disconnecting must not cancel the work the others are waiting for
+        return await asyncio.shield(task)
+
+    def finish(self, key, task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.results[key] = task.result()
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+
+
+@dataclass
+class WarmState:
+    """Aggregates for one database state, shared by every request until the fingerprint changes"""
+    fingerprint: str
+    srid: int
+    stats: DashboardStats
+    regions: dict = field(default_factory=dict)
+    # Region name -> WKB of its boundary, so filtered heatmaps do not re-union the boundary per request
+    region_geometries: dict = field(default_factory=dict)
+
+
+def load_state(engine, fingerprint, parallelism=DEFAULT_PARALLELISM, admin_level=KRAJ_ADMIN_LEVEL):
+    """Gather the country and per-region statistics with the batch code paths
+
+    Raises if any query group failed, so the previous state keeps being served instead of
+    fallback values. QUERY_LOG is restarted, so pages show the timings of this build only.
+    """
+    QUERY_LOG.clear()
+    scheduler = QueryScheduler(parallelism)
+    failures = []
+    geometries = scheduler.submit('region geometries', fetch_region_geometries, engine, regions_cte(admin_level), True,
+                                  default={}, failures=failures).result()
+    region_stats = collect_region_statistics(engine, scheduler, region_values_cte(geometries), failures)
+    stats = collect_statistics(engine, scheduler)
+    scheduler.close()
+    failures += stats.failed_groups
+    if failures:
+        raise RuntimeError(f"query groups failed: {', '.join(failures)}")
+    srid = stats.srid_info if isinstance(stats.srid_info, int) else 3857
+    return WarmState(fingerprint, srid, stats, region_stats, geometries)
+
+
+def filtered_heatmap_sql(amenity=None, kraj=None, cell_size=HEATMAP_CELL_SIZES[HEATMAP_ZOOM]):
+    """heatmap_query with the amenity/region filters as psycopg parameters"""
+    where = "amenity = %(amenity)s AND way IS NOT NULL" if amenity else HEATMAP_FILTER
+    region = ''
+    if kraj:
+        region = ", (SELECT ST_GeomFromWKB(%(geometry)s, %(srid)s) AS geom) r"
+        where += " AND way && r.geom AND ST_Intersects(r.geom, way)"
+    return f"""
+        SELECT ST_X(center) AS lon, ST_Y(center) AS lat, weight
+        FROM (
+            SELECT ST_Transform(ST_SetSRID(ST_MakePoint(AVG(ST_X(way)), AVG(ST_Y(way))), %(srid)s), 4326) AS center,
+                   COUNT(*) AS weight
+            FROM planet_osm_point{region}
+            WHERE {where}
+            GROUP BY FLOOR(ST_X(way) / {float(cell_size)}), FLOOR(ST_Y(way) / {float(cell_size)})
+        ) cells
+    """
+
+
+def first(params, name):
+    values = params.get(name)
+    return values[0] if values and values[0] else None
+
+
+class DashboardServer:
+    """Routes: / (dashboard page), /heatmap (map page for the iframe) and /heatmap.json"""
+
+    def __init__(self, engine, pool, chart_renderer, parallelism=DEFAULT_PARALLELISM,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL, admin_level=KRAJ_ADMIN_LEVEL):
+        self.engine = engine
+        self.pool = pool
+        self.chart_renderer = chart_renderer
+        self.parallelism = parallelism
+        self.refresh_interval = refresh_interval
+        self.admin_level = admin_level
+        self.state = None
+        self.heatmaps = Coalescer()
+        self.responses = Coalescer()
+        self.routes = {'/': self.render_page, '/heatmap': self.render_map, '/heatmap.json': self.render_points}
+
+    async def keep_warm(self):
+        """Rebuild the aggregates whenever the database fingerprint changes (retried next interval if it fails)"""
+        while True:
+            try:
+                fingerprint = await asyncio.to_thread(database_fingerprint, self.engine)
+                if self.state is None or fingerprint != self.state.fingerprint:
+                    print("Warming dashboard aggregates...")
+                    start = time.perf_counter()
+                    self.state = await asyncio.to_thread(load_state, self.engine, fingerprint,
+                                                         self.parallelism, self.admin_level)
+                    self.heatmaps.clear()
+                    self.responses.clear()
+                    print(f"✅ Aggregates for {len(self.state.regions)} regions ready in {time.perf_counter() - start:.2f}s")
+            except Exception as e:
+                print(f"Refreshing the dashboard aggregates failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def heatmap(self, state, amenity, kraj):
+        """(points, rows_fetched, poi_total) for the filters, one query per distinct filter and state"""
+        async def fetch():
+            params = {'amenity': amenity, 'geometry': state.region_geometries.get(kraj), 'srid': state.srid}
+            async with self.pool.connection() as conn:
+                cursor = await conn.execute(filtered_heatmap_sql(amenity, kraj), params)
+                rows = await cursor.fetchall()
+            points = np.array([[lat, lon, weight] for lon, lat, weight in rows if lon is not None and lat is not None],
+                              dtype=float).reshape(-1, 3)
+            return points, len(rows), int(points[:, 2].sum())
+        return await self.heatmaps.get((state.fingerprint, amenity, kraj), fetch)
+
+    def title(self, amenity, kraj):
+        """Page title (the statistics cover the whole kraj/country) and the heatmap's title, which names the amenity"""
+        title = escape(kraj) if kraj else 'Czech Republic'
+        return title, f"{title} – amenity={escape(amenity)}" if amenity else title
+
+    def filter_form(self, state, amenity, kraj):
+        options = ''.join(f'<option{" selected" if name == kraj else ""}>{escape(name)}</option>'
+                          for name in sorted(state.regions))
+        return f'''
+        <div class="visualization">
+            <form method="get" action="/" style="display: flex; gap: 15px; align-items: center; flex-wrap: wrap;">
+                <label>Kraj <select name="kraj"><option value="">Whole country</option>{options}</select></label>
+                <label>Heatmap amenity <input name="amenity" value="{escape(amenity or '')}" placeholder="e.g. cafe"></label>
+                <button type="submit">Filter</button>
+            </form>
+        </div>
+        '''
+
+    async def render_page(self, state, amenity, kraj):
+        points, rows_fetched, poi_total = await self.heatmap(state, amenity, kraj)
+        stats = state.regions[kraj] if kraj else state.stats
+        title, heatmap_title = self.title(amenity, kraj)
+        map_src = escape('/heatmap?' + urlencode({name: value for name, value in (('kraj', kraj), ('amenity', amenity)) if value}))
+        # The amenity filter narrows the heatmap only; the cards and charts below are the kraj/country totals
+        heatmap_html = self.filter_form(state, amenity, kraj) + heatmap_section(
+            map_src, rows_fetched, len(points) > 0, poi_total, heatmap_title)
+        html = await asyncio.to_thread(dashboard_html, stats, heatmap_html, self.chart_renderer, title)
+        return html.encode('utf-8'), 'text/html; charset=utf-8'
+
+    async def render_map(self, state, amenity, kraj):
+        points, _, _ = await self.heatmap(state, amenity, kraj)
+        html = await asyncio.to_thread(lambda: heatmap_map(points, fit_map=bool(kraj)).get_root().render())
+        return html.encode('utf-8'), 'text/html; charset=utf-8'
+
+    async def render_points(self, state, amenity, kraj):
+        points, rows_fetched, poi_total = await self.heatmap(state, amenity, kraj)
+        body = json.dumps({'points': points.tolist(), 'rows': rows_fetched, 'poi_total': poi_total})
+        return body.encode('utf-8'), 'application/json'
+
+    async def respond(self, method, target, headers):
+        """(status, headers, body) for one request"""
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b'Method not allowed'
+        url = urlsplit(target)
+        route = self.routes.get(url.path)
+        if route is None:
+            return 404, {}, b'Not found'
+        state = self.state
+        if state is None:
+            return 503, {'Retry-After': '10'}, b'Dashboard aggregates are still warming up'
+        params = parse_qs(url.query)
+        amenity, kraj = first(params, 'amenity'), first(params, 'kraj')
+        if kraj and kraj not in state.regions:
+            return 404, {}, b'Unknown kraj'
+
+        # The content is determined by the database state and the filters, so the ETag is known before
+        # anything is rendered and a revalidation costs no query at all. It is weak: pages also carry
+        # their render time and query timings, which differ between renders of the same content
+        key = (state.fingerprint, url.path, amenity, kraj)
+        etag = 'W/"' + hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()[:32] + '"'
+        response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            return 304, response_headers, b''
+        body, content_type = await self.responses.get(key, lambda: route(state, amenity, kraj))
+        response_headers['Content-Type'] = content_type
+        return 200, response_headers, body
+
+    async def handle(self, reader, writer):
+        """Minimal HTTP/1.1 connection handler with keep-alive"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    status, response_headers, body = await self.respond(method, target, headers)
+                except Exception as e:
+                    print(f"Request {target} failed: {e}")
+                    status, response_headers, body = 500, {}, b'Internal server error'
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                response_headers['Content-Length'] = str(len(body))
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                writer.write(f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}\r\n".encode('latin-1'))
+                writer.write(''.join(f"{name}: {value}\r\n" for name, value in response_headers.items()).encode('latin-1'))
+                writer.write(b'\r\n')
+                if method != 'HEAD' and status != 304:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+STATUS_REASONS = {200: 'OK', 304: 'Not Modified', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, pool_size=DEFAULT_POOL_SIZE, parallelism=DEFAULT_PARALLELISM,
+                query_timeout=None, refresh_interval=DEFAULT_REFRESH_INTERVAL, admin_level=KRAJ_ADMIN_LEVEL,
+                chart_workers=None, chart_backend='svg'):
+    engine = make_engine(parallelism, query_timeout)
+    pool = AsyncPool(libpq_url(engine), pool_size, query_timeout)
+    chart_renderer = ChartRenderer(chart_workers, chart_backend)
+    server = DashboardServer(engine, pool, chart_renderer, parallelism, refresh_interval, admin_level)
+    warm = asyncio.create_task(server.keep_warm())
+    http = await asyncio.start_server(server.handle, host, port, backlog=1024)
+    print(f"🌐 Serving the dashboard on http://{host}:{port}/")
+    try:
+        async with http:
+            await http.serve_forever()
+    finally:
+        warm.cancel()
+        await pool.close()
+        chart_renderer.close()
+        print(f"Heatmaps: {server.heatmaps.misses} queried, {server.heatmaps.coalesced} coalesced, "
+              f"{server.heatmaps.hits} from memory")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the OSM dashboard with filters from warm in-memory aggregates")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help="async connections for the per-request heatmap queries")
+    parser.add_argument('--parallelism', type=int, default=DEFAULT_PARALLELISM,
+                        help="query groups run concurrently while (re)building the aggregates")
+    parser.add_argument('--query-timeout', type=float, default=None,
+                        help="cancel any single query after this many seconds")
+    parser.add_argument('--refresh-interval', type=float, default=DEFAULT_REFRESH_INTERVAL,
+                        help="seconds between checks whether the database changed")
+    parser.add_argument('--admin-level', type=int, default=KRAJ_ADMIN_LEVEL,
+                        help="admin_level of the boundaries offered in the kraj filter")
+    parser.add_argument('--chart-workers', type=int, default=None,
+                        help="worker processes for png charts")
+    parser.add_argument('--chart-backend', choices=['png', 'svg'], default='svg',
+                        help="chart renderer; svg (default) is much cheaper per page")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.pool_size, args.parallelism, args.query_timeout,
+                          args.refresh_interval, args.admin_level, args.chart_workers, args.chart_backend))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from main import DashboardStats, StatsHistory, stats_metrics
+
+
+class StatsHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'history.npz')
+        self.snapshot = np.datetime64('2026-01-15T00:00:00')
+
+    def test_fast_counts_rerun_keeps_exact_totals(self):
+        exact = DashboardStats(total_nodes=100, total_ways=20, total_relations=3, pois=7,
+                               amenities=[('cafe', 5), ('pub', 2)])
+        StatsHistory(self.path).append(self.snapshot, stats_metrics(exact))
+
+        estimated = DashboardStats(total_nodes=90, total_ways=25, total_relations=4, pois=8,
+                                   amenities=[('cafe', 6)], approximate_counts=True)
+        StatsHistory(self.path).append(self.snapshot, stats_metrics(estimated))
+
+        history = StatsHistory(self.path)
+        self.assertEqual(len(history.snapshots), 1)
+        for metric, value in (('total_nodes', 100), ('total_ways', 20), ('total_relations', 3),
+                              ('pois', 8), ('amenity=cafe', 6), ('amenity=pub', 2)):
+            self.assertEqual(history.series(metric)[1].tolist(), [value], metric)
+
+
+if __name__ == '__main__':
+    unittest.main()